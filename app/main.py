@@ -1,14 +1,29 @@
-import base64
+import asyncio
+import hashlib
+import heapq
+import multiprocessing
 import os
+import re
+import tempfile
+import threading
 import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, BinaryIO, Iterator, List, Tuple
+from urllib.parse import urlparse
 
+import orjson
+import pybase64
 from fastapi import FastAPI, Header, HTTPException, BackgroundTasks
-from fastapi.responses import Response, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markdown_it import MarkdownIt
 
 from weasyprint import HTML, CSS
 from weasyprint.urls import default_url_fetcher
@@ -18,7 +33,7 @@ from weasyprint.urls import default_url_fetcher
 # Configuration (sécurité / RGPD)
 # -----------------------------
 API_KEY = os.getenv("API_KEY", "")  # si vide => pas de contrôle
-MAX_CHARS = int(os.getenv("MAX_CHARS", "400000"))  # limite de taille HTML
+MAX_CHARS = int(os.getenv("MAX_CHARS", "400000"))  # limite de taille HTML/Markdown (octets UTF-8)
 ALLOW_REMOTE_ASSETS = os.getenv("ALLOW_REMOTE_ASSETS", "false").lower() == "true"
 ALLOWED_REMOTE_HOSTS = set(
     h.strip().lower() for h in os.getenv("ALLOWED_REMOTE_HOSTS", "").split(",") if h.strip()
@@ -31,6 +46,22 @@ PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "https://auditreportgen.enstso.co
 PDF_STORE_DIR = os.getenv("PDF_STORE_DIR", "/data/pdfs")
 PDF_TTL_SECONDS = int(os.getenv("PDF_TTL_SECONDS", "3600"))  # 1h
 DELETE_AFTER_FIRST_DOWNLOAD = os.getenv("DELETE_AFTER_FIRST_DOWNLOAD", "false").lower() == "true"
+CLEANUP_INTERVAL_SECONDS = int(os.getenv("CLEANUP_INTERVAL_SECONDS", "60"))
+
+# Rendu WeasyPrint (CPU) déporté dans un pool de processus
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+STREAM_CHUNK_SIZE = 64 * 1024
+B64_CHUNK_SIZE = 57 * 1024  # multiple de 3 : aucun padding base64 au milieu du flux
+
+# Cache des PDFs déjà rendus pour /generate-pdf-url (HTML + version du CSS -> blob du store) ;
+# 0 = désactivé. /generate-pdf et /generate-pdf-json ne conservent jamais rien sur disque.
+# Les autres assets file: (images de assets/) ne font pas partie de la clé : une image
+# modifiée peut être servie périmée jusqu'au TTL. Désactivé si ALLOW_REMOTE_ASSETS=true.
+PDF_CACHE_ENTRIES = int(os.getenv("PDF_CACHE_ENTRIES", "64"))
+
+# PDFs adressés par contenu (sha256) ; les tokens sont des liens physiques vers ces blobs.
+# Tokens et blobs sont répartis en 256 sous-répertoires (2 premiers caractères hex).
+BLOBS_DIR = Path(PDF_STORE_DIR) / "blobs"
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
@@ -39,9 +70,79 @@ ASSETS_DIR = os.path.join(BASE_DIR, "assets")
 env = Environment(
     loader=FileSystemLoader(TEMPLATES_DIR),
     autoescape=select_autoescape(["html", "xml"]),
+    auto_reload=False,
+    cache_size=400,
 )
 
-app = FastAPI(title="AuditReportGen PDF Backend", version="1.2.0")
+# Parser Markdown construit une seule fois (compilation des règles coûteuse)
+MD_PARSER = MarkdownIt("commonmark", {"html": True, "linkify": True, "typographer": True})
+
+# Template obligatoire : compilé une fois au démarrage (échec immédiat si absent)
+REPORT_TEMPLATE = env.get_template("report.html")
+
+# Pool créé à la demande (jamais à l'import) : les workers "spawn" ré-importent
+# ce module sans recréer de pool.
+_POOL: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warmup,
+        )
+    return _POOL
+
+
+def _prestart_pool():
+    # une soumission par worker : tous démarrent (et se préchauffent) dès le lancement
+    pool = _get_pool()
+    for _ in range(PDF_WORKERS):
+        pool.submit(int)
+
+
+def _shutdown_pool(pool: Optional[ProcessPoolExecutor] = None):
+    """Arrête le pool courant ; si pool est fourni, seulement s'il est encore le pool courant."""
+    global _POOL
+    if _POOL is not None and (pool is None or _POOL is pool):
+        _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL = None
+
+
+async def _run_in_pool(fn, *args):
+    """Exécute fn(*args) dans le pool sans bloquer la boucle d'événements."""
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # worker tué (OOM, segfault...) : on repart sur un pool neuf au prochain appel ;
+        # jamais celui qu'une requête plus récente aurait déjà recréé
+        _shutdown_pool(pool)
+        raise
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    _prestart_pool()
+    _rebuild_expiry_heap()
+    cleanup_task = asyncio.create_task(_cleanup_loop())
+    yield
+    cleanup_task.cancel()
+    _shutdown_pool()
+
+
+app = FastAPI(
+    title="AuditReportGen PDF Backend",
+    version="1.2.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+# compresse le JSON (base64) ; les PDFs, déjà compressés, le contournent via
+# "Content-Encoding: identity". Niveau 6 : le niveau 9 coûte cher sur plusieurs Mo.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
 
 
 # -----------------------------
@@ -69,22 +170,117 @@ def _check_key(x_api_key: Optional[str]):
 
 
 def _ensure_store():
-    Path(PDF_STORE_DIR).mkdir(parents=True, exist_ok=True)
+    BLOBS_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def _token_path(token: str) -> Path:
+    return Path(PDF_STORE_DIR) / token[:2] / f"{token}.pdf"
+
+
+def _scan_files(path) -> Iterator[os.DirEntry]:
+    """Fichiers sous path, shards compris (os.scandir : pas de stat pour le parcours)."""
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+        except OSError:
+            pass
+
+
+# Expirations en attente (tokens et blobs) : min-heap de (expires_at, chemin)
+_EXPIRY_HEAP: List[Tuple[float, str]] = []
+_EXPIRY_LOCK = threading.Lock()
+
+
+def _schedule_expiry(path, expires_at: float):
+    with _EXPIRY_LOCK:
+        heapq.heappush(_EXPIRY_HEAP, (expires_at, str(path)))
+
+
+def _rebuild_expiry_heap():
+    """
+    Au démarrage : reconstruit le heap depuis le disque (seul parcours complet du store).
+    Les fichiers hors shards (ancienne disposition) sont planifiés eux aussi.
+    """
+    for entry in _scan_files(PDF_STORE_DIR):
+        try:
+            _schedule_expiry(entry.path, entry.stat().st_mtime + PDF_TTL_SECONDS)
+        except Exception:
+            pass
 
 
 def _cleanup_expired():
-    """Supprime les PDFs expirés (best-effort)."""
-    _ensure_store()
+    """Supprime les PDFs expirés puis les blobs qui ne sont plus référencés (best-effort)."""
     now = time.time()
-    for p in Path(PDF_STORE_DIR).glob("*.pdf"):
+    expired = []
+    with _EXPIRY_LOCK:
+        while _EXPIRY_HEAP and _EXPIRY_HEAP[0][0] <= now:
+            expired.append(Path(heapq.heappop(_EXPIRY_HEAP)[1]))
+
+    # tokens d'abord : libère les liens physiques vers les blobs
+    blobs = []
+    for p in expired:
+        if p.is_relative_to(BLOBS_DIR):
+            blobs.append(p)
+        else:
+            # l'inode survit via le blob : on libère quand même ses pages en cache
+            _drop_page_cache(p)
+            _delete_quiet(p)
+
+    # st_nlink == 1 : plus aucun token ne pointe vers le blob ; sinon (encore lié, ou
+    # mtime récent car réutilisé) on le replanifie, faute de quoi il ne serait plus jamais revu
+    for p in blobs:
         try:
-            if now - p.stat().st_mtime > PDF_TTL_SECONDS:
+            st = p.stat()
+            if st.st_nlink <= 1 and now - st.st_mtime >= PDF_TTL_SECONDS:
                 p.unlink(missing_ok=True)
+            else:
+                retry_at = max(st.st_mtime + PDF_TTL_SECONDS, now + CLEANUP_INTERVAL_SECONDS)
+                _schedule_expiry(p, retry_at)
         except Exception:
             # best-effort: ne pas faire échouer un PDF à cause du cleanup
             pass
 
 
+async def _cleanup_loop():
+    # expiration garantie même sans trafic sur /generate-pdf-url
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
+        await asyncio.to_thread(_cleanup_expired)
+
+
+def _delete_quiet(path: Path):
+    try:
+        path.unlink(missing_ok=True)
+    except Exception:
+        pass
+
+
+def _drop_page_cache(path: Path):
+    """Indique au noyau que les pages du fichier ne seront plus relues (best-effort)."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+_LOCAL_SCHEMES = ("data:", "file:")
+_REMOTE_SCHEMES = ("http://", "https://")
+
+
 def _safe_url_fetcher(url: str):
     """
     Sécurité / RGPD :
@@ -95,16 +291,15 @@ def _safe_url_fetcher(url: str):
     u = (url or "").strip()
     ul = u.lower()
 
-    if ul.startswith("data:") or ul.startswith("file:"):
+    if ul.startswith(_LOCAL_SCHEMES):
         return default_url_fetcher(u)
 
-    if ul.startswith("http://") or ul.startswith("https://"):
+    if ul.startswith(_REMOTE_SCHEMES):
         if not ALLOW_REMOTE_ASSETS:
             raise ValueError(f"Remote asset blocked: {u}")
 
         # allowlist simple (host exact)
         if ALLOWED_REMOTE_HOSTS:
-            from urllib.parse import urlparse
             host = (urlparse(u).hostname or "").lower()
             if host not in ALLOWED_REMOTE_HOSTS:
                 raise ValueError(f"Remote host not allowed: {host}")
@@ -115,32 +310,44 @@ def _safe_url_fetcher(url: str):
 
 
 def _markdown_to_html(md: str) -> str:
-    from markdown_it import MarkdownIt
-    md_parser = MarkdownIt("commonmark", {"html": True, "linkify": True, "typographer": True})
-    return md_parser.render(md)
+    return MD_PARSER.render(md)
+
+
+# <link rel="stylesheet"> du contenu : styles.css fait foi, et ces feuilles
+# seraient soit bloquées (assets distants), soit parsées pour rien par WeasyPrint
+# [^<>] : le motif ne sort jamais de la balise courante (pas de backtracking quadratique)
+_STYLESHEET_LINK_RE = re.compile(
+    r"""<link\b[^<>]*?\brel\s*=\s*["']?stylesheet\b[^<>]*>""", re.IGNORECASE
+)
+
+
+def _check_size(text: str):
+    """Limite MAX_CHARS comptée en octets UTF-8 (un caractère peut en peser 4)."""
+    n = len(text)
+    # encodage évité quand le nombre de caractères suffit à conclure
+    if n * 4 > MAX_CHARS and (n > MAX_CHARS or len(text.encode("utf-8", errors="ignore")) > MAX_CHARS):
+        raise HTTPException(status_code=413, detail=f"Content too large (>{MAX_CHARS} bytes)")
 
 
 def _render_html(req: PdfRequest) -> str:
     if req.content_html and req.content_md:
         # on laisse passer mais on priorise HTML pour éviter ambiguïté
         body_html = req.content_html
+        _check_size(body_html)
     elif req.content_html:
         body_html = req.content_html
+        _check_size(body_html)
     elif req.content_md:
+        # vérifié avant le parsing : pas de CPU dépensé sur une entrée rejetée
+        _check_size(req.content_md)
         body_html = _markdown_to_html(req.content_md)
+        _check_size(body_html)
     else:
         raise HTTPException(status_code=400, detail="Provide content_html or content_md")
 
-    if len(body_html) > MAX_CHARS:
-        raise HTTPException(status_code=413, detail=f"Content too large (>{MAX_CHARS} chars)")
-
-    # Template obligatoire
-    try:
-        template = env.get_template("report.html")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Template not found: {e}")
+    body_html = _STYLESHEET_LINK_RE.sub("", body_html)
 
-    return template.render(
+    return REPORT_TEMPLATE.render(
         title=req.title,
         subtitle=req.subtitle,
         client=req.client,
@@ -150,35 +357,215 @@ def _render_html(req: PdfRequest) -> str:
     )
 
 
-def _load_css() -> CSS:
-    css_path = os.path.join(ASSETS_DIR, "styles.css")
-    if os.path.exists(css_path):
-        return CSS(filename=css_path)
+CSS_PATH = os.path.join(ASSETS_DIR, "styles.css")
 
-    # fallback minimal si styles.css absent
-    fallback = """
-    @page { size: A4; margin: 18mm 16mm; }
-    body { font-family: DejaVu Sans, Arial, sans-serif; font-size: 10.5pt; line-height: 1.45; color: #111; }
-    img { max-width: 100%; height: auto; object-fit: contain; }
-    table { width: 100%; border-collapse: collapse; }
-    th, td { border: 1px solid #ddd; padding: 6pt; vertical-align: top; }
-    """
-    return CSS(string=fallback)
+# fallback minimal si styles.css absent
+FALLBACK_CSS = """
+@page { size: A4; margin: 18mm 16mm; }
+body { font-family: DejaVu Sans, Arial, sans-serif; font-size: 10.5pt; line-height: 1.45; color: #111; }
+img { max-width: 100%; height: auto; object-fit: contain; }
+table { width: 100%; border-collapse: collapse; }
+th, td { border: 1px solid #ddd; padding: 6pt; vertical-align: top; }
+"""
+
+
+def _css_mtime() -> Optional[float]:
+    try:
+        return os.stat(CSS_PATH).st_mtime
+    except OSError:
+        return None
+
+
+def _load_css(mtime: Optional[float]) -> CSS:
+    if mtime is not None:
+        return CSS(filename=CSS_PATH)
+    return CSS(string=FALLBACK_CSS)
+
+
+# CSS parsé une seule fois par processus (parsing coûteux dans WeasyPrint)
+_CSS_LOCK = threading.Lock()
+_CSS_MTIME = _css_mtime()
+_CSS_OBJ = _load_css(_CSS_MTIME)
 
 
-def _generate_pdf_bytes(html_str: str) -> bytes:
-    css = _load_css()
+def _get_css() -> CSS:
+    """Retourne le CSS en cache ; re-parse seulement si styles.css a changé (dev)."""
+    global _CSS_MTIME, _CSS_OBJ
+    mtime = _css_mtime()
+    if mtime != _CSS_MTIME:
+        with _CSS_LOCK:
+            if mtime != _CSS_MTIME:
+                _CSS_OBJ = _load_css(mtime)
+                _CSS_MTIME = mtime
+    return _CSS_OBJ
+
+
+def _write_pdf(html_str: str, target):
+    # exécuté dans un worker du pool : fonction top-level (picklable)
     html = HTML(string=html_str, base_url=BASE_DIR, url_fetcher=_safe_url_fetcher)
-    return html.write_pdf(stylesheets=[css])
+    html.write_pdf(target=target, stylesheets=[_get_css()])
+
+
+def _warmup():
+    """
+    Initializer des workers : un premier rendu initialise fontconfig/Pango/HarfBuzz,
+    sinon le premier vrai PDF de chaque worker paie ce coût (plusieurs secondes).
+    """
+    try:
+        HTML(string="<p>x</p>").write_pdf(stylesheets=[_get_css()])
+    except Exception:
+        # best-effort : un échec ici casserait tout le pool
+        pass
+
+
+def _generate_pdf_file(html_str: str) -> str:
+    """
+    Écrit le PDF dans un fichier temporaire et retourne son chemin :
+    le PDF complet ne transite pas (pickle) entre worker et processus principal.
+    """
+    fd, path = tempfile.mkstemp(prefix="auditgen-", suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            _write_pdf(html_str, f)
+    except BaseException:
+        Path(path).unlink(missing_ok=True)
+        raise
+    return path
+
+
+class _HashingWriter:
+    """Calcule le sha256 du PDF pendant son écriture (une seule passe)."""
+
+    def __init__(self, f: BinaryIO):
+        self._f = f
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        return self._f.write(data)
+
+
+def _open_blob_tmp(dir_fd: int) -> Tuple[int, Optional[str]]:
+    """
+    Fichier temporaire anonyme (O_TMPFILE) dans blobs/ : rien de visible avant la
+    publication atomique, aucun résidu si le worker meurt en cours d'écriture.
+    Repli sur mkstemp si le système de fichiers ne le supporte pas.
+    """
+    if hasattr(os, "O_TMPFILE"):
+        try:
+            return os.open(".", os.O_TMPFILE | os.O_WRONLY, 0o600, dir_fd=dir_fd), None
+        except OSError:
+            pass
+    return tempfile.mkstemp(dir=BLOBS_DIR, prefix=".tmp-", suffix=".part")
+
+
+def _store_pdf_blob(html_str: str) -> str:
+    """
+    Génère le PDF directement dans le store, adressé par son sha256 :
+    un PDF identique n'est écrit qu'une fois dans blobs/. Retourne le chemin du blob.
+    """
+    dir_fd = os.open(BLOBS_DIR, os.O_RDONLY | os.O_DIRECTORY)
+    tmp_path = None
+    try:
+        fd, tmp_path = _open_blob_tmp(dir_fd)
+        link_src = tmp_path or f"/proc/self/fd/{fd}"
+        with os.fdopen(fd, "wb") as f:
+            writer = _HashingWriter(f)
+            _write_pdf(html_str, writer)
+            # contenu complet avant publication ; pas de fsync (PDFs éphémères)
+            f.flush()
+            digest = writer.sha256.hexdigest()
+            os.makedirs(BLOBS_DIR / digest[:2], exist_ok=True)
+            blob_name = f"{digest[:2]}/{digest}.pdf"
+            try:
+                # publication atomique, échoue si déjà présent (équivalent O_EXCL) ;
+                # dst_dir_fd => linkat(AT_SYMLINK_FOLLOW), requis pour /proc/self/fd
+                os.link(link_src, blob_name, dst_dir_fd=dir_fd)
+            except FileExistsError:
+                # déjà présent : rafraîchi pour que le cleanup ne le supprime pas
+                os.utime(blob_name, dir_fd=dir_fd)
+    finally:
+        if tmp_path:
+            Path(tmp_path).unlink(missing_ok=True)
+        os.close(dir_fd)
+    return str(BLOBS_DIR / blob_name)
+
+
+def _open_unlinked(path: str) -> BinaryIO:
+    """Ouvre puis supprime le fichier : plus de fuite possible, libéré à la fermeture."""
+    f = open(path, "rb")
+    os.unlink(path)
+    return f
+
+
+def _iter_file(f: BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _iter_json_b64(prefix: bytes, f: BinaryIO) -> Iterator[bytes]:
+    """Enveloppe JSON écrite à la main : le base64 est encodé morceau par morceau."""
+    yield prefix
+    for chunk in _iter_file(f, B64_CHUNK_SIZE):
+        yield pybase64.b64encode(chunk)
+    yield b'"}'
+
+
+_PDF_CACHE: "OrderedDict[str, str]" = OrderedDict()
+
+
+def _pdf_cache_key(html_str: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr(_css_mtime()).encode("ascii"))
+    h.update(html_str.encode("utf-8"))
+    return h.hexdigest()
+
+
+async def _render_blob(html_str: str) -> str:
+    """
+    Retourne le blob du store pour ce HTML : réutilisé depuis le cache (retries,
+    requêtes identiques) ou rendu dans le pool. L'expiration du blob est planifiée.
+    """
+    _ensure_store()
+    # contenu distant imprévisible : pas de cache
+    cacheable = PDF_CACHE_ENTRIES > 0 and not ALLOW_REMOTE_ASSETS
+    key = _pdf_cache_key(html_str) if cacheable else None
+    blob_path = _PDF_CACHE.get(key) if key else None
+    if blob_path is not None:
+        try:
+            # rafraîchi : le cleanup ne le supprimera pas
+            os.utime(blob_path)
+            _PDF_CACHE.move_to_end(key)
+        except FileNotFoundError:
+            # blob expiré entre-temps
+            del _PDF_CACHE[key]
+            blob_path = None
+
+    if blob_path is None:
+        blob_path = await _run_in_pool(_store_pdf_blob, html_str)
+        if key:
+            _PDF_CACHE[key] = blob_path
+            while len(_PDF_CACHE) > PDF_CACHE_ENTRIES:
+                _PDF_CACHE.popitem(last=False)
+
+    _schedule_expiry(blob_path, time.time() + PDF_TTL_SECONDS)
+    return blob_path
+
+
+# tokens de téléchargement : uuid4().hex
+_TOKEN_RE = re.compile(r"\A[0-9a-f]{32}\Z")
+
+# \w (unicode) == isalnum() ou "_" : accents conservés pour les titres FR
+_FILENAME_STRIP_RE = re.compile(r"[^\w .\-]+")
 
 
 def _safe_filename(title: str) -> str:
     # simplification : évite caractères problématiques
-    keep = []
-    for ch in (title or "rapport"):
-        if ch.isalnum() or ch in (" ", "_", "-", "."):
-            keep.append(ch)
-    name = "".join(keep).strip().replace(" ", "_")
+    name = _FILENAME_STRIP_RE.sub("", title or "rapport").strip().replace(" ", "_")
     return (name[:80] if name else "rapport") + ".pdf"
 
 
@@ -191,14 +578,16 @@ def health():
 
 
 @app.post("/generate-pdf")
-def generate_pdf(req: PdfRequest, x_api_key: Optional[str] = Header(default=None)):
+async def generate_pdf(req: PdfRequest, x_api_key: Optional[str] = Header(default=None)):
     """
     Retour binaire application/pdf
     """
     _check_key(x_api_key)
     try:
-        html_str = _render_html(req)
-        pdf_bytes = _generate_pdf_bytes(html_str)
+        # Markdown + Jinja + nettoyage : CPU, hors boucle d'événements
+        html_str = await asyncio.to_thread(_render_html, req)
+        pdf_path = await _run_in_pool(_generate_pdf_file, html_str)
+        pdf_file = _open_unlinked(pdf_path)
     except HTTPException:
         raise
     except Exception as e:
@@ -206,37 +595,47 @@ def generate_pdf(req: PdfRequest, x_api_key: Optional[str] = Header(default=None
         raise HTTPException(status_code=500, detail=f"PDF generation failed: {e}")
 
     filename = _safe_filename(req.title)
-    return Response(
-        content=pdf_bytes,
+    return StreamingResponse(
+        _iter_file(pdf_file),
         media_type="application/pdf",
         headers={
             "Content-Disposition": f'inline; filename="{filename}"',
+            "Content-Length": str(os.fstat(pdf_file.fileno()).st_size),
+            "Content-Encoding": "identity",
             "Cache-Control": "no-store",
         },
     )
 
 
 @app.post("/generate-pdf-json")
-def generate_pdf_json(req: PdfRequest, x_api_key: Optional[str] = Header(default=None)):
+async def generate_pdf_json(req: PdfRequest, x_api_key: Optional[str] = Header(default=None)):
     """
     Retour JSON { filename, pdf_base64 }
     """
     _check_key(x_api_key)
     try:
-        html_str = _render_html(req)
-        pdf_bytes = _generate_pdf_bytes(html_str)
+        # Markdown + Jinja + nettoyage : CPU, hors boucle d'événements
+        html_str = await asyncio.to_thread(_render_html, req)
+        pdf_path = await _run_in_pool(_generate_pdf_file, html_str)
+        pdf_file = _open_unlinked(pdf_path)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"PDF generation failed: {e}")
 
     filename = _safe_filename(req.title)
-    b64 = base64.b64encode(pdf_bytes).decode("ascii")
-    return JSONResponse({"filename": filename, "pdf_base64": b64})
+    prefix = b'{"filename": ' + orjson.dumps(filename) + b', "pdf_base64": "'
+    pdf_size = os.fstat(pdf_file.fileno()).st_size
+    b64_size = 4 * ((pdf_size + 2) // 3)
+    return StreamingResponse(
+        _iter_json_b64(prefix, pdf_file),
+        media_type="application/json",
+        headers={"Content-Length": str(len(prefix) + b64_size + 2)},
+    )
 
 
 @app.post("/generate-pdf-url")
-def generate_pdf_url(
+async def generate_pdf_url(
     req: PdfRequest,
     background_tasks: BackgroundTasks,
     x_api_key: Optional[str] = Header(default=None),
@@ -247,64 +646,65 @@ def generate_pdf_url(
     """
     _check_key(x_api_key)
 
-    # nettoyage best-effort avant génération
-    _cleanup_expired()
-    _ensure_store()
+    # nettoyage best-effort avant génération (hors boucle d'événements : I/O disque)
+    await asyncio.to_thread(_cleanup_expired)
 
     try:
-        html_str = _render_html(req)
-        pdf_bytes = _generate_pdf_bytes(html_str)
+        # Markdown + Jinja + nettoyage : CPU, hors boucle d'événements
+        html_str = await asyncio.to_thread(_render_html, req)
+        blob_path = await _render_blob(html_str)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"PDF generation failed: {e}")
 
     token = uuid.uuid4().hex  # non devinable
-    file_path = Path(PDF_STORE_DIR) / f"{token}.pdf"
+    file_path = _token_path(token)
     try:
-        file_path.write_bytes(pdf_bytes)
+        file_path.parent.mkdir(exist_ok=True)
+        # lien physique : aucun octet dupliqué pour un PDF identique
+        os.link(blob_path, file_path)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Cannot write PDF: {e}")
 
+    expires_at = time.time() + PDF_TTL_SECONDS
+    _schedule_expiry(file_path, expires_at)
+
     # Optionnel : un cleanup après réponse (best-effort)
     background_tasks.add_task(_cleanup_expired)
 
-    expires_at = int(time.time() + PDF_TTL_SECONDS)
+    expires_at = int(expires_at)
     pdf_url = f"{PUBLIC_BASE_URL}/download/{token}"
 
     return {"pdf_url": pdf_url, "expires_at": expires_at}
 
 
 @app.get("/download/{token}")
-def download_pdf(token: str):
+def download_pdf(token: str, background_tasks: BackgroundTasks):
     """
     Télécharge le PDF généré. Peut être supprimé après 1er download si DELETE_AFTER_FIRST_DOWNLOAD=true.
     """
     token = (token or "").strip()
-    # validation simple
-    if not token.isalnum() or len(token) < 16:
+    # validation stricte : uuid4().hex uniquement (ASCII, pas de chiffres unicode)
+    if not _TOKEN_RE.match(token):
         raise HTTPException(status_code=400, detail="Invalid token")
 
-    file_path = Path(PDF_STORE_DIR) / f"{token}.pdf"
+    file_path = _token_path(token)
+    if not file_path.exists():
+        # liens émis avant le passage aux shards (à retirer un TTL après la mise à jour)
+        file_path = Path(PDF_STORE_DIR) / f"{token}.pdf"
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="File not found or expired")
 
-    try:
-        pdf_bytes = file_path.read_bytes()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Cannot read PDF: {e}")
-
+    # une fois l'envoi terminé : le PDF ne sera a priori plus relu, on libère le page cache
+    background_tasks.add_task(_drop_page_cache, file_path)
     if DELETE_AFTER_FIRST_DOWNLOAD:
-        try:
-            file_path.unlink(missing_ok=True)
-        except Exception:
-            pass
+        background_tasks.add_task(_delete_quiet, file_path)
 
-    return Response(
-        content=pdf_bytes,
+    # envoi en flux depuis le disque, sans charger le PDF en mémoire
+    return FileResponse(
+        path=str(file_path),
         media_type="application/pdf",
-        headers={
-            "Content-Disposition": 'attachment; filename="audit.pdf"',
-            "Cache-Control": "no-store",
-        },
+        filename="audit.pdf",
+        headers={"Content-Encoding": "identity", "Cache-Control": "no-store"},
     )
@@ -0,0 +1,24 @@
+import time
+
+import pytest
+
+try:
+    from app.main import MAX_CHARS, PdfRequest, _render_html
+except (ImportError, OSError) as e:  # WeasyPrint absent ou libs Pango manquantes
+    pytest.skip(f"app.main non importable : {e}", allow_module_level=True)
+
+
+def test_stylesheet_links_are_stripped():
+    html = _render_html(PdfRequest(
+        content_html='<p>a</p><link rel="stylesheet" href="https://x/b.css"><link rel="icon" href="x">'
+    ))
+    assert "b.css" not in html
+    assert 'rel="icon"' in html
+
+
+def test_stylesheet_link_strip_is_linear():
+    # régression : "<link" répété déclenchait un backtracking quadratique (~200 s à 400 Ko)
+    payload = "<link" * (MAX_CHARS // len("<link"))
+    start = time.perf_counter()
+    _render_html(PdfRequest(content_html=payload))
+    assert time.perf_counter() - start < 2